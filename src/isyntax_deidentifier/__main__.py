@@ -1,28 +1,92 @@
 import argparse
+import contextlib
 import functools
-import io
+import os
+import queue
 import sys
+import threading
 
 from pathlib import Path
-from typing import Sequence
+from typing import BinaryIO, Iterator, Sequence
 
 from .isyntax_deidentifier import deidentify_isyntax
 
+IO_CHUNK = 4 << 20
+_SENDFILE_CHUNK_SIZE = 1 << 30
+_READ_AHEAD_DEPTH = 4
+
+
+def _read_ahead(
+    f: BinaryIO, chunk_size: int, depth: int = _READ_AHEAD_DEPTH
+) -> Iterator[bytes]:
+    chunks: queue.Queue[bytes | BaseException] = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def reader():
+        try:
+            while not stop.is_set() and (chunk := f.read(chunk_size)):
+                chunks.put(chunk)
+            if not stop.is_set():
+                chunks.put(b"")
+        except BaseException as exc:
+            if not stop.is_set():
+                chunks.put(exc)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while chunk := chunks.get():
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+        with contextlib.suppress(queue.Empty):
+            chunks.get_nowait()
+        thread.join()
+
+
+def _copy_from_offset(f_in: BinaryIO, f_out: BinaryIO, offset: int, chunk_size: int):
+    f_out.flush()
+    if hasattr(os, "sendfile"):
+        try:
+            while sent := os.sendfile(
+                f_out.fileno(), f_in.fileno(), offset, _SENDFILE_CHUNK_SIZE
+            ):
+                offset += sent
+            return
+        except OSError:
+            pass
+    f_in.seek(offset)
+    for chunk in _read_ahead(f_in, chunk_size):
+        f_out.write(chunk)
+
 
 def main(args):
     input_file_mode = "r+b" if args.inplace else "rb"
-    chunk_header = not args.inplace
     with open(args.input_img, input_file_mode) as f_in:
-        slide_it = iter(functools.partial(f_in.read, io.DEFAULT_BUFFER_SIZE), b"")
-        slide_it = deidentify_isyntax(slide_it, chunk_header=chunk_header)
+        slide_it = iter(functools.partial(f_in.read, args.chunk_size), b"")
+        slide_it = deidentify_isyntax(slide_it, chunk_header=False)
+        xml_header = next(slide_it)
         if args.inplace:
-            xml_header = next(slide_it)
             f_in.seek(0)
             f_in.write(xml_header)
         else:
             with open(args.output_img, "xb") as f_out:
-                for chunk in slide_it:
-                    f_out.write(chunk)
+                with memoryview(xml_header) as header_view:
+                    for i in range(0, len(header_view), IO_CHUNK):
+                        f_out.write(header_view[i : i + IO_CHUNK])
+                _copy_from_offset(f_in, f_out, len(xml_header), args.chunk_size)
+
+
+def _positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"{value!r} is not a positive integer")
+    return number
 
 
 def parse_args(args: Sequence[str] | None = None):
@@ -30,6 +94,12 @@ def parse_args(args: Sequence[str] | None = None):
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     parser.add_argument("input_img", type=Path, help="Input image path")
+    parser.add_argument(
+        "--chunk-size",
+        type=_positive_int,
+        default=IO_CHUNK,
+        help="Read chunk size in bytes",
+    )
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument(
         "-o", "--output-img", type=Path, default=None, help="Output image path"
@@ -1,29 +1,116 @@
 import itertools
+import re
 
-from io import BytesIO
-from lxml import etree
-from typing import Iterator, Literal, Tuple, cast, overload
+from typing import Iterator, Literal, Tuple, overload
+from xml.parsers import expat
 
 from .exceptions import BarcodeError, FormatError, ImagesError, LabelError
 
+_START_TAG_RE = re.compile(rb"""<(?:[^>"']|"[^"]*"|'[^']*')*>""")
+_END_TAG_RE = re.compile(rb"</[^>]*>")
+_HEADER_END_SEARCH_SIZE = 64
+_GROUPS = frozenset(("0x301D", "0x301d"))
+_BARCODE_ATTRIBUTE = ("PIM_DP_UFS_BARCODE", "0x1002", "IString")
+_IMAGES_ATTRIBUTE = ("PIM_DP_SCANNED_IMAGES", "0x1003", "IDataObjectArray")
+_IMAGE_TYPE_ATTRIBUTE = ("PIM_DP_IMAGE_TYPE", "0x1004", "IString")
+
+
+def _match_attribute(
+    attrs: dict[str, str], name: str, element: str, pmsvr: str
+) -> bool:
+    return (
+        attrs.get("Name") == name
+        and attrs.get("Group") in _GROUPS
+        and attrs.get("Element") == element
+        and attrs.get("PMSVR") == pmsvr
+    )
+
 
-def deidentify_isyntax_header(header: bytes | bytearray | memoryview) -> bytes:
+class _HeaderScanner:
+    """Records the byte offsets of the header elements to deidentify.
+
+    Offsets are those reported by expat: start offsets point at the ``<`` of
+    the start tag, end offsets at the ``<`` of the end tag, or just past the
+    tag for empty elements.
+    """
+
+    def __init__(self) -> None:
+        self.root: tuple[str, dict[str, str]] | None = None
+        # (start, end) of barcode elements
+        self.barcodes: list[tuple[int, int]] = []
+        # start of images arrays
+        self.images: list[int] = []
+        # (start, end) of label data objects in the images arrays
+        self.labels: list[tuple[int, int]] = []
+        # [name, attrs, start, is_label] of the currently open elements
+        self._stack: list[list] = []
+        self._label_text: list[str] | None = None
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.SetParamEntityParsing(expat.XML_PARAM_ENTITY_PARSING_NEVER)
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._data
+
+    def parse(self, header: bytes | bytearray | memoryview) -> None:
+        self._parser.Parse(header, True)
+
+    def _start(self, name: str, attrs: dict[str, str]) -> None:
+        depth = len(self._stack)
+        if depth == 0:
+            self.root = (name, attrs)
+        elif name == "Attribute" and depth == 4 and self.images:
+            parent_name, parent_attrs, _, _ = self._stack[-1]
+            if (
+                self._stack[-2][2] == self.images[-1]
+                and parent_name == "DataObject"
+                and parent_attrs.get("ObjectType") == "DPScannedImage"
+                and _match_attribute(attrs, *_IMAGE_TYPE_ATTRIBUTE)
+            ):
+                self._label_text = []
+        elif name == "Array" and depth == 2:
+            parent_name, parent_attrs, _, _ = self._stack[-1]
+            if parent_name == "Attribute" and _match_attribute(
+                parent_attrs, *_IMAGES_ATTRIBUTE
+            ):
+                self.images.append(self._parser.CurrentByteIndex)
+        self._stack.append([name, attrs, self._parser.CurrentByteIndex, False])
+
+    def _end(self, name: str) -> None:
+        _, attrs, start, is_label = self._stack.pop()
+        end = self._parser.CurrentByteIndex
+        depth = len(self._stack)
+        if name == "Attribute":
+            if depth == 1 and _match_attribute(attrs, *_BARCODE_ATTRIBUTE):
+                self.barcodes.append((start, end))
+            elif self._label_text is not None and _match_attribute(
+                attrs, *_IMAGE_TYPE_ATTRIBUTE
+            ):
+                if "".join(self._label_text) == "LABELIMAGE":
+                    self._stack[-1][3] = True
+                self._label_text = None
+        elif is_label:
+            self.labels.append((start, end))
+
+    def _data(self, data: str) -> None:
+        if self._label_text is not None:
+            self._label_text.append(data)
+
+
+def deidentify_isyntax_header(header: bytes | bytearray | memoryview) -> bytearray:
+    scanner = _HeaderScanner()
     try:
-        header_root = etree.parse(
-            BytesIO(header), parser=etree.XMLParser(huge_tree=True)
-        ).getroot()
+        scanner.parse(header)
     except Exception as exc:
         raise FormatError("Error decoding header") from exc
 
-    if (
-        header_root.tag != "DataObject"
-        or header_root.attrib.get("ObjectType") != "DPUfsImport"
-    ):
-        raise FormatError("Invalid header root element")
+    match scanner.root:
+        case ("DataObject", {"ObjectType": "DPUfsImport"}):
+            pass
+        case _:
+            raise FormatError("Invalid header root element")
 
-    match header_root.xpath(
-        "./Attribute[@Name='PIM_DP_UFS_BARCODE'][@Group='0x301D' or @Group='0x301d'][@Element='0x1002'][@PMSVR='IString']"
-    ):
+    match scanner.barcodes:
         case [barcode]:
             pass
         case []:
@@ -31,23 +118,15 @@ def deidentify_isyntax_header(header: bytes | bytearray | memoryview) -> bytes:
         case [*res]:
             raise BarcodeError(f"Single barcode element expected, {len(res)} found")
 
-    barcode = cast(etree._Element, barcode)
-    barcode.text = None
-
-    match header_root.xpath(
-        "./Attribute[@Name='PIM_DP_SCANNED_IMAGES'][@Group='0x301D' or @Group='0x301d'][@Element='0x1003'][@PMSVR='IDataObjectArray']/Array"
-    ):
-        case [images]:
+    match scanner.images:
+        case [_]:
             pass
         case []:
             raise ImagesError("Images not found")
         case [*res]:
             raise ImagesError(f"Single images element expected, {len(res)} found")
 
-    images = cast(etree._Element, images)
-    match images.xpath(
-        "./DataObject[@ObjectType='DPScannedImage']/Attribute[@Name='PIM_DP_IMAGE_TYPE'][@Group='0x301D' or @Group='0x301d'][@Element='0x1004'][@PMSVR='IString'][.='LABELIMAGE']/.."
-    ):
+    match scanner.labels:
         case [label]:
             pass
         case []:
@@ -55,41 +134,40 @@ def deidentify_isyntax_header(header: bytes | bytearray | memoryview) -> bytes:
         case [*res]:
             raise LabelError(f"Single label expected, {len(res)} found")
 
-    label = cast(etree._Element, label)
-    images.remove(label)
-
-    xml_declaration = b'<?xml version="1.0" encoding="UTF-8"?>\n'
-    xml_body = etree.tostring(
-        header_root,
-        encoding="UTF-8",
-        method="xml",
-        xml_declaration=False,
-        pretty_print=False,
-    )
-    header_deid = xml_declaration + xml_body
-
-    padding_len = len(header) - len(header_deid)
-    if padding_len < 0:
-        raise FormatError(
-            "Deidentified header size must be lower than equal to the original header size"
+    barcode_start, barcode_end = barcode
+    barcode_text_start = _START_TAG_RE.match(header, barcode_start).end()
+    label_start, label_end = label
+    label_end = _END_TAG_RE.match(header, label_end).end()
+    # The barcode is a child of the root and the label is nested in the images
+    # array, so the two ranges never overlap.
+    parts = []
+    pos = 0
+    with memoryview(header) as header_view:
+        for start, end in sorted(
+            ((barcode_text_start, barcode_end), (label_start, label_end))
+        ):
+            parts.append(header_view[pos:start])
+            pos = end
+        parts.append(header_view[pos:])
+        parts.append(
+            b"\n" * (barcode_end - barcode_text_start + label_end - label_start)
         )
-    header_deid += b"\n" * padding_len
-    return header_deid
+        return bytearray().join(parts)
 
 
 def find_isyntax_header(slide_it: Iterator[bytes], buff: bytearray) -> Tuple[int, int]:
     chunk_size = 0
-    header_delimiter_found = False
-    while not header_delimiter_found:
+    header_delimiter_end = -1
+    while header_delimiter_end < 0:
         try:
             chunk = next(slide_it)
         except StopIteration:
             raise FormatError("Header not found")
         chunk_size = chunk_size or len(chunk)
+        chunk_delimiter_end = chunk.find(b"\x04")
+        if chunk_delimiter_end > -1:
+            header_delimiter_end = len(buff) + chunk_delimiter_end
         buff.extend(chunk)
-        start = len(buff) - len(chunk)
-        header_delimiter_end = buff.find(b"\x04", start)
-        header_delimiter_found = header_delimiter_end > -1
 
     header_delimiter_start = header_delimiter_end - 2
     if (
@@ -98,12 +176,20 @@ def find_isyntax_header(slide_it: Iterator[bytes], buff: bytearray) -> Tuple[int
     ):
         raise FormatError("Error decoding header")
 
-    header_size = buff.rfind(b">", 0, header_delimiter_start) + 1
+    search_start = max(0, header_delimiter_start - _HEADER_END_SEARCH_SIZE)
+    header_size = buff.rfind(b">", search_start, header_delimiter_start) + 1
+    if header_size <= 0 and search_start > 0:
+        header_size = buff.rfind(b">", 0, header_delimiter_start) + 1
     if header_size <= 0:
         raise FormatError("Error decoding header")
     return header_size, chunk_size
 
 
+def _iter_chunks(buff: bytearray | memoryview, chunk_size: int) -> Iterator[memoryview]:
+    buff_view = memoryview(buff)
+    return (buff_view[i : i + chunk_size] for i in range(0, len(buff), chunk_size))
+
+
 @overload
 def deidentify_isyntax(
     slide_it: Iterator[bytes],
@@ -123,20 +209,26 @@ def deidentify_isyntax(
 ) -> Iterator[bytes] | tuple[Iterator[bytes], bytes]:
     buff = bytearray()
     header_size, chunk_size = find_isyntax_header(slide_it, buff)
-    header = memoryview(buff)[:header_size]
+    with memoryview(buff) as buff_view:
+        header_deid = deidentify_isyntax_header(buff_view[:header_size])
+        if ret_original_header:
+            original_header = bytes(buff_view[:header_size])
     if ret_original_header:
-        original_header = bytes(header)
-
-    header_deid = deidentify_isyntax_header(header)
-    header[:] = header_deid
+        # The original header is already copied out: emit the deidentified
+        # header and the buffered bytes after it as separate pieces instead of
+        # writing the header back into buff.
+        buff_pieces = (header_deid, memoryview(buff)[header_size:])
+    else:
+        buff[:header_size] = header_deid
+        buff_pieces = (buff,)
 
     if chunk_header:
-        buff_chunks = (
-            buff[i : i + chunk_size] for i in range(0, len(buff), chunk_size)
+        buff_chunks = itertools.chain.from_iterable(
+            _iter_chunks(piece, chunk_size) for piece in buff_pieces
         )
         ret = itertools.chain(buff_chunks, slide_it)
     else:
-        ret = itertools.chain((buff,), slide_it)
+        ret = itertools.chain(buff_pieces, slide_it)
 
     if ret_original_header:
         return ret, original_header
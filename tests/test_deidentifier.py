@@ -2,15 +2,18 @@ import functools
 import hashlib
 import io
 import logging
+import os
 import pytest
+import random
 import requests
 import shutil
+import threading
 
 from pathlib import Path
 from pixelengine import PixelEngine
 from typing import Iterator
 
-from isyntax_deidentifier.__main__ import main, parse_args
+from isyntax_deidentifier.__main__ import IO_CHUNK, _read_ahead, main, parse_args
 from isyntax_deidentifier import (
     BarcodeError,
     FormatError,
@@ -54,7 +57,7 @@ def slide(tmp_path_factory: pytest.TempPathFactory) -> Path:
     with open(slide, "rb") as f:
         done = False
         while not done:
-            data = f.read(io.DEFAULT_BUFFER_SIZE)
+            data = f.read(IO_CHUNK)
             if data == b"":
                 done = True
             else:
@@ -64,10 +67,29 @@ def slide(tmp_path_factory: pytest.TempPathFactory) -> Path:
     return slide
 
 
+@pytest.fixture
+def synthetic_slide(tmp_path: Path) -> Path:
+    mock_header = b"""<?xml version="1.0" encoding="UTF-8"?>
+<DataObject ObjectType="DPUfsImport">
+    <Attribute Name="PIM_DP_UFS_BARCODE" Group="0x301D" Element="0x1002" PMSVR="IString">BARCODE123</Attribute>
+    <Attribute Name="PIM_DP_SCANNED_IMAGES" Group="0x301D" Element="0x1003" PMSVR="IDataObjectArray">
+        <Array>
+            <DataObject ObjectType="DPScannedImage">
+                <Attribute Name="PIM_DP_IMAGE_TYPE" Group="0x301D" Element="0x1004" PMSVR="IString">LABELIMAGE</Attribute>
+            </DataObject>
+        </Array>
+    </Attribute>
+</DataObject>
+\r\n\x04"""
+    slide = tmp_path / "synthetic.isyntax"
+    slide.write_bytes(mock_header + random.Random(0).randbytes(3 * IO_CHUNK))
+    return slide
+
+
 def test_deidentify_chunked(slide: Path, tmp_path: Path):
     output = tmp_path / "testslide_deid.isyntax"
     with open(slide, "rb") as f_in:
-        slide_it = iter(functools.partial(f_in.read, io.DEFAULT_BUFFER_SIZE), b"")
+        slide_it = iter(functools.partial(f_in.read, IO_CHUNK), b"")
         with open(output, "wb"):
             slide_it = deidentify_isyntax(slide_it, chunk_header=True)
             with open(output, "wb") as f_out:
@@ -79,7 +101,7 @@ def test_deidentify_chunked(slide: Path, tmp_path: Path):
 def test_deidentify_not_chunked(slide: Path, tmp_path: Path):
     output = tmp_path / "testslide_deid.isyntax"
     with open(slide, "rb") as f_in:
-        slide_it = iter(functools.partial(f_in.read, io.DEFAULT_BUFFER_SIZE), b"")
+        slide_it = iter(functools.partial(f_in.read, IO_CHUNK), b"")
         with open(output, "wb"):
             slide_it = deidentify_isyntax(slide_it, chunk_header=False)
             with open(output, "wb") as f_out:
@@ -89,7 +111,7 @@ def test_deidentify_not_chunked(slide: Path, tmp_path: Path):
 
 def test_ret_original_header(slide: Path):
     with open(slide, "rb") as f_in:
-        slide_it = iter(functools.partial(f_in.read, io.DEFAULT_BUFFER_SIZE), b"")
+        slide_it = iter(functools.partial(f_in.read, IO_CHUNK), b"")
         _, original_header = deidentify_isyntax(slide_it, ret_original_header=True)
         f_in.seek(0)
         assert original_header == f_in.read(len(original_header))
@@ -102,6 +124,71 @@ def test_cli(slide: Path, tmp_path: Path):
     assert _check_deid(output)
 
 
+def test_cli_synthetic(synthetic_slide: Path, tmp_path: Path):
+    output = tmp_path / "synthetic_deid.isyntax"
+    args = parse_args([str(synthetic_slide), "-o", str(output)])
+    main(args)
+    slide_data = synthetic_slide.read_bytes()
+    output_data = output.read_bytes()
+    header_size = slide_data.index(b"\r\n\x04")
+    assert output_data.index(b"\r\n\x04") == header_size
+    assert output_data[header_size:] == slide_data[header_size:]
+    assert b"BARCODE123" not in output_data[:header_size]
+    assert b"LABELIMAGE" not in output_data[:header_size]
+
+
+@pytest.mark.parametrize("sendfile", ["missing", "failing"])
+def test_cli_sendfile_fallback(
+    synthetic_slide: Path,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    sendfile: str,
+):
+    if sendfile == "missing":
+        monkeypatch.delattr(os, "sendfile", raising=False)
+    else:
+
+        def failing_sendfile(*args):
+            raise OSError("sendfile not supported")
+
+        monkeypatch.setattr(os, "sendfile", failing_sendfile)
+    output = tmp_path / "synthetic_deid.isyntax"
+    args = parse_args([str(synthetic_slide), "-o", str(output), "--chunk-size", "65536"])
+    main(args)
+    slide_data = synthetic_slide.read_bytes()
+    expected = b"".join(deidentify_isyntax(_make_iter(slide_data, 65536)))
+    assert output.read_bytes() == expected
+
+
+def test_read_ahead():
+    threads = set(threading.enumerate())
+    data = bytes(range(256)) * 64
+    assert b"".join(_read_ahead(io.BytesIO(data), 100, depth=2)) == data
+    assert set(threading.enumerate()) == threads
+
+
+def test_read_ahead_close():
+    threads = set(threading.enumerate())
+    chunks = _read_ahead(io.BytesIO(b"\0" * 1000), 10, depth=2)
+    assert next(chunks) == b"\0" * 10
+    chunks.close()
+    assert set(threading.enumerate()) == threads
+
+
+def test_read_ahead_error():
+    class FailingReader(io.BytesIO):
+        def read(self, size=-1):
+            if self.tell() >= 100:
+                raise OSError("read failed")
+            return super().read(size)
+
+    threads = set(threading.enumerate())
+    with pytest.raises(OSError, match="read failed"):
+        for _ in _read_ahead(FailingReader(b"\0" * 1000), 10, depth=2):
+            pass
+    assert set(threading.enumerate()) == threads
+
+
 def test_cli_inplace(slide: Path, tmp_path: Path):
     slide_copy = tmp_path / "testslide.isyntax"
     shutil.copyfile(slide, slide_copy)
@@ -118,6 +205,14 @@ def test_cli_output_exists(slide: Path, tmp_path: Path):
         main(args)
 
 
+def test_cli_chunk_size():
+    args = parse_args(["slide.isyntax", "-o", "out.isyntax", "--chunk-size", "16"])
+    assert args.chunk_size == 16
+    for chunk_size in ["0", "-1", "abc"]:
+        with pytest.raises(SystemExit):
+            parse_args(["slide.isyntax", "-o", "out.isyntax", "--chunk-size", chunk_size])
+
+
 def test_invalid_header_delimiter():
     mock_headers = [
         (
@@ -296,6 +391,31 @@ def test_no_label():
         deidentify_isyntax(header_it)
 
 
+def test_label_outside_images():
+    mock_header = b"""<?xml version="1.0" encoding="UTF-8"?>
+<DataObject ObjectType="DPUfsImport">
+    <Attribute Name="PIM_DP_UFS_BARCODE" Group="0x301D" Element="0x1002" PMSVR="IString" />
+    <Attribute Name="PIM_DP_SCANNED_IMAGES" Group="0x301D" Element="0x1003" PMSVR="IDataObjectArray">
+        <Array>
+            <DataObject ObjectType="DPScannedImage" />
+        </Array>
+    </Attribute>
+    <Attribute Name="OTHER_IMAGES" Group="0x301D" Element="0x1005" PMSVR="IDataObjectArray">
+        <Array>
+            <DataObject ObjectType="DPScannedImage">
+                <Attribute Name="PIM_DP_IMAGE_TYPE" Group="0x301D" Element="0x1004" PMSVR="IString">LABELIMAGE</Attribute>
+            </DataObject>
+        </Array>
+    </Attribute>
+</DataObject>
+\r\n\x04
+"""
+    chunk_size = 16
+    header_it = _make_iter(mock_header, chunk_size)
+    with pytest.raises(LabelError):
+        deidentify_isyntax(header_it)
+
+
 def test_multiple_labels():
     mock_header = b"""<?xml version="1.0" encoding="UTF-8"?>
 <DataObject ObjectType="DPUfsImport">
@@ -317,3 +437,30 @@ def test_multiple_labels():
     header_it = _make_iter(mock_header, chunk_size)
     with pytest.raises(LabelError):
         deidentify_isyntax(header_it)
+
+
+def test_deidentified_header():
+    mock_header = b"""<?xml version="1.0" encoding="UTF-8"?>
+<DataObject ObjectType="DPUfsImport">
+    <Attribute Name="PIM_DP_UFS_BARCODE" Group="0x301D" Element="0x1002" PMSVR="IString">BARCODE123</Attribute>
+    <Attribute Name="PIM_DP_SCANNED_IMAGES" Group="0x301D" Element="0x1003" PMSVR="IDataObjectArray">
+        <Array>
+            <DataObject ObjectType="DPScannedImage">
+                <Attribute Name="PIM_DP_IMAGE_TYPE" Group="0x301D" Element="0x1004" PMSVR="IString">LABELIMAGE</Attribute>
+            </DataObject>
+            <DataObject ObjectType="DPScannedImage">
+                <Attribute Name="PIM_DP_IMAGE_TYPE" Group="0x301D" Element="0x1004" PMSVR="IString">WSI</Attribute>
+            </DataObject>
+        </Array>
+    </Attribute>
+</DataObject>
+\r\n\x04
+"""
+    chunk_size = 16
+    header_it = _make_iter(mock_header, chunk_size)
+    header_deid = b"".join(deidentify_isyntax(header_it))
+    assert len(header_deid) == len(mock_header)
+    assert header_deid.endswith(b"\r\n\x04\n")
+    assert b"BARCODE123" not in header_deid
+    assert b"LABELIMAGE" not in header_deid
+    assert b"WSI" in header_deid